@@ -1,8 +1,6 @@
 import os
-import json
-import re
 import streamlit as st
-import openai
+import orjson
 from datetime import datetime
 from utils import (
     extract_text_from_file,
@@ -11,6 +9,7 @@ from utils import (
     generate_mcqs_via_openai,
     send_result_email,
     export_results_to_excel_bytes,
+    export_results_to_csv_bytes,
     record_attempt,
     list_attempts,
 )
@@ -33,8 +32,6 @@ else:
     ADMIN_USER = os.getenv("ADMIN_USER", "admin")
     ADMIN_PASS = os.getenv("ADMIN_PASS", "admin123")
 
-openai.api_key = OPENAI_API_KEY
-
 # ==========================
 # BASIC UI CONFIG
 # ==========================
@@ -50,26 +47,38 @@ else:
 # LOCAL DATA STORAGE
 # ==========================
 LOCAL_QUIZ_FILE = "quizzes.json"
-LOCAL_RESULTS_FILE = "results.json"
+VALID_LETTERS = {"A", "B", "C", "D"}
+EXCEL_EXPORT_MAX_ROWS = 5000  # larger result sets are offered as CSV only
 
 
 def load_local_data(file):
     if os.path.exists(file):
         try:
-            with open(file, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(file, "rb") as f:
+                return orjson.loads(f.read())
         except:
             return []
     return []
 
 
 def save_local_data(file, data):
-    with open(file, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    with open(file, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
 
 quizzes = load_local_data(LOCAL_QUIZ_FILE)
-results = load_local_data(LOCAL_RESULTS_FILE)
+
+
+# ==========================
+# UPLOAD PIPELINE CACHE
+# ==========================
+# Streamlit reruns the whole script on every widget change (even typing the quiz
+# title). Each step below is cached in utils by content hash: parse_mcqs in memory,
+# extraction and generation on disk, where empty or incomplete results are skipped so
+# a failed OCR or OpenAI call is retried instead of pinned.
+def mcqs_for_text(text):
+    return parse_mcqs(text) if detect_mcq(text) else generate_mcqs_via_openai(text)
+
 
 # ==========================
 # SIDEBAR – MODE SWITCH
@@ -111,8 +120,7 @@ if mode == "Admin":
 
             if text.strip():
                 with st.spinner("🔍 Parsing document for MCQs..."):
-                    is_mcq = detect_mcq(text)
-                    mcqs = parse_mcqs(text) if is_mcq else generate_mcqs_via_openai(text)
+                    mcqs = mcqs_for_text(text)
 
                 if not mcqs:
                     st.error("❌ No MCQs could be generated or detected.")
@@ -152,7 +160,7 @@ if mode == "Admin":
     # TAB 3: STUDENT RESULTS
     with tabs[2]:
         st.subheader("📊 Student Results")
-        results = load_local_data(LOCAL_RESULTS_FILE)
+        results = list_attempts()
         if not results:
             st.info("No results available yet.")
         else:
@@ -167,8 +175,15 @@ if mode == "Admin":
                 for r in results
             ]
             st.dataframe(df_data)
-            excel_bytes = export_results_to_excel_bytes(df_data)
-            st.download_button("📥 Download Results (Excel)", data=excel_bytes, file_name="student_results.xlsx")
+            # Building the xlsx is the slow part of the tab; past the limit only CSV
+            # (which Excel opens directly) is built on each rerun
+            if len(df_data) <= EXCEL_EXPORT_MAX_ROWS:
+                excel_bytes = export_results_to_excel_bytes(df_data)
+                st.download_button("📥 Download Results (Excel)", data=excel_bytes, file_name="student_results.xlsx")
+            else:
+                st.caption(f"Excel export is disabled above {EXCEL_EXPORT_MAX_ROWS} results; the CSV opens in Excel.")
+            csv_bytes = export_results_to_csv_bytes(df_data)
+            st.download_button("📥 Download Results (CSV)", data=csv_bytes, file_name="student_results.csv")
 
 # ==========================
 # STUDENT PANEL
@@ -176,13 +191,17 @@ if mode == "Admin":
 elif mode == "Student":
     st.header("🎓 Student Quiz Panel")
 
-    quiz_titles = [q["title"] for q in quizzes] if quizzes else []
+    # Title -> quiz index for O(1) lookups (first quiz wins on duplicate titles)
+    quiz_by_title = {}
+    for q in quizzes:
+        quiz_by_title.setdefault(q["title"], q)
+    quiz_titles = list(quiz_by_title)
     if not quiz_titles:
         st.warning("No quizzes available yet. Please ask the admin to upload one.")
         st.stop()
 
     selected_quiz = st.selectbox("Choose a quiz:", quiz_titles)
-    selected = next((q for q in quizzes if q["title"] == selected_quiz), None)
+    selected = quiz_by_title.get(selected_quiz)
 
     if not selected:
         st.error("Quiz not found.")
@@ -216,22 +235,13 @@ elif mode == "Student":
             total = len(mcqs)
             for i, q in enumerate(mcqs):
                 correct_letter = q.get("correct", "A").strip().upper()
-                correct_index = ord(correct_letter) - 65 if correct_letter in "ABCD" else 0
+                correct_index = ord(correct_letter) - 65 if correct_letter in VALID_LETTERS else 0
                 if selected_answers.get(i) == correct_index:
                     score += 1
 
             st.success(f"✅ You scored {score} out of {total}")
 
-            attempt = {
-                "student_name": student_name,
-                "student_email": student_email,
-                "quiz_title": selected_quiz,
-                "score": score,
-                "total": total,
-                "timestamp": datetime.utcnow().isoformat(),
-            }
-            results.append(attempt)
-            save_local_data(LOCAL_RESULTS_FILE, results)
+            record_attempt(selected_quiz, selected_quiz, student_name, student_email, selected_answers, score, total)
 
             send_result_email(student_email, student_name, selected_quiz, score, total)
             st.info("📧 Result emailed successfully!")
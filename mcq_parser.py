@@ -0,0 +1,320 @@
+import re
+import difflib
+import hashlib
+import threading
+from collections import OrderedDict
+from enum import Enum
+from typing import Optional
+
+# Kept free of hard third-party imports and fully annotated so the module can be
+# compiled ahead of time with mypyc (`mypyc mcq_parser.py`); utils.py imports
+# the compiled extension transparently when it is present.
+
+# ==========================
+# HELPERS
+# ==========================
+def _ws(s: str) -> str:
+    """Collapses internal whitespace runs to single spaces and trims the ends."""
+    return " ".join(s.split())
+
+
+# ==========================
+# BLOCK PARSERS
+# ==========================
+class Template(Enum):
+    """MCQ layouts common enough to deserve a specialized grammar."""
+    STANDARD = "standard"          # "A) ..." options, then "Answer: B"
+    LETTER_COLON = "letter_colon"  # "A: ..." or "A. ..." options, then "Answer: B"
+    NO_ANSWER = "no_answer"        # options with no answer key
+
+
+# Token kinds produced by _tokenize()
+TOKEN_HEADER = 0
+TOKEN_OPTION = 1
+TOKEN_ANSWER = 2
+TOKEN_ANSWER_TEXT = 3  # "Answer: Paris" - resolved against the options afterwards
+_TOKEN_KINDS = {
+    "option": TOKEN_OPTION,
+    "answer": TOKEN_ANSWER,
+    "answer_text": TOKEN_ANSWER_TEXT,
+}
+
+
+# "Ans" / "answer" / "ANSWER": spelled-out ASCII case classes keep the tokenizer out of
+# IGNORECASE mode, which folds case on every character it compares
+_ANS_MARKER = r"\b[Aa][Nn][Ss](?:[Ww][Ee][Rr])?"
+
+# The whole document is tokenized in one scan: question-block starts (a numbered line:
+# "1.", "Q2)", "q 3:"), "Ans: X" / "Answer: <text>" markers and option labels
+_DOC_TOKEN_RE = re.compile(
+    r"(?P<start>^[^\S\n]*(?:[Qq][^\S\n]*)?\d+[).:])"
+    r"|(?P<answer>" + _ANS_MARKER + r"\s*[:\-]?\s*[A-Da-d]\b)"
+    r"|(?P<answer_text>" + _ANS_MARKER + r"\s*[:\-])"
+    r"|(?P<option>(?<![A-Za-z0-9])[A-D][).:])",
+    re.MULTILINE,
+)
+
+# The tokens each layout's grammar accepts: option label punctuation, and whether
+# answer markers count; blocks fall back to _GENERIC_GRAMMAR
+_GENERIC_GRAMMAR = (").:", True)
+_TEMPLATE_GRAMMAR = {
+    Template.STANDARD: (")", True),
+    Template.LETTER_COLON: (".:", True),
+    Template.NO_ANSWER: (").:", False),
+}
+
+
+def _tokenize(text: str) -> list[tuple[int, int, list[tuple[int, int, int]]]]:
+    """
+    Splits the text into question blocks and tokens in one left-to-right scan. Returns
+    (start, end, tokens) for every block holding an option label, where tokens are
+    (start, end, kind) spans into the text; titles and intro text are dropped.
+    """
+    blocks: list[tuple[int, int, list[tuple[int, int, int]]]] = []
+    start = 0
+    tokens: list[tuple[int, int, int]] = []
+    has_label = False
+    for m in _DOC_TOKEN_RE.finditer(text):
+        kind = m.lastgroup or ""
+        if kind == "start":
+            if has_label:
+                blocks.append((start, m.start(), tokens))
+            start = m.start()
+            tokens = []
+            has_label = False
+            line = m.group()
+            head = start + len(line) - len(line.lstrip())
+            # "12." and "Q 12." are headers; a lowercase "q12." stays part of the question
+            if text[head] != "q":
+                tokens.append((head, m.end(), TOKEN_HEADER))
+            continue
+        if not has_label and kind != "answer_text":
+            # A label only marks a question block after a word boundary ("_A)" doesn't);
+            # the key letter of "Ans: B)" counts as one too
+            pos = m.start() if kind == "option" else m.end() - 1
+            prev = text[pos - 1] if pos else " "
+            has_label = (
+                "A" <= text[pos] <= "D"
+                and text[pos + 1:pos + 2] in (")", ".", ":")
+                and not (prev.isalnum() or prev == "_")
+            )
+        tokens.append((m.start(), m.end(), _TOKEN_KINDS[kind]))
+    if has_label:
+        blocks.append((start, len(text), tokens))
+    return blocks
+
+
+def _classify_template(text: str, head_blocks: list[tuple[int, int, list[tuple[int, int, int]]]]) -> Template:
+    """Guesses the document's layout from the tokens of its first question blocks."""
+    has_answer = False
+    paren = 0
+    other = 0
+    for _, _, tokens in head_blocks:
+        seen_option = False
+        for start, end, kind in tokens:
+            if kind == TOKEN_ANSWER or kind == TOKEN_ANSWER_TEXT:
+                has_answer = has_answer or seen_option
+            elif kind == TOKEN_OPTION:
+                seen_option = True
+                if text[end - 1] == ")":
+                    paren += 1
+                else:
+                    other += 1
+    if not has_answer:
+        return Template.NO_ANSWER
+    return Template.STANDARD if paren >= other else Template.LETTER_COLON
+
+
+_ANSWER_MATCH_CUTOFF = 80  # minimum 0-100 similarity for a free-text answer to pick an option
+
+
+def _match_answer_text(answer: str, opts: list[str]) -> Optional[str]:
+    """Resolves a free-text answer ("Answer: Paris") to the letter of the closest option."""
+    ans = answer.strip(" .").lower()
+    if not ans:
+        return None
+    lowered = [o.lower() for o in opts]
+    if ans in lowered:
+        return chr(65 + lowered.index(ans))
+    try:
+        from rapidfuzz import fuzz, process
+    except ImportError:
+        for i, o in enumerate(lowered):
+            # Whole words only, so option "no" doesn't claim "none of these"
+            if re.search(rf"\b{re.escape(ans)}\b", o) or re.search(rf"\b{re.escape(o)}\b", ans):
+                return chr(65 + i)
+        close = difflib.get_close_matches(ans, lowered, n=1, cutoff=_ANSWER_MATCH_CUTOFF / 100)
+        return chr(65 + lowered.index(close[0])) if close else None
+    # WRatio tolerates OCR noise and extra words without letting a short option match
+    # inside unrelated text ("Onion" in "none of these"); unclear answers stay unresolved
+    match = process.extractOne(ans, lowered, scorer=fuzz.WRatio, score_cutoff=_ANSWER_MATCH_CUTOFF)
+    return chr(65 + match[2]) if match else None
+
+
+def _make_mcq(question: str, opts: list[str], correct: Optional[str]) -> dict:
+    # Pad/truncate to 4
+    while len(opts) < 4:
+        opts.append("N/A")
+    return {
+        "question": question,
+        "options": opts[:4],
+        "correct": correct
+    }
+
+
+def _join_lines(s: str) -> str:
+    """Trims a slice of the raw text and joins its lines with single spaces."""
+    return _LINE_BREAK_RE.sub(" ", s.strip())
+
+
+def _parse_block(
+    text: str,
+    block_start: int,
+    block_end: int,
+    tokens: list[tuple[int, int, int]],
+    grammar: tuple[str, bool],
+    min_options: int,
+) -> Optional[dict]:
+    """
+    Parses one block's tokens against the grammar
+
+        block  := header? question option* answer?
+        option := label text        (labels strictly A, B, C, D in order)
+        answer := "Ans: X" | "Answer: <option text>"
+
+    The question is the text between the header and the first option, and each
+    option runs from its label to the next accepted token. Answer markers only count
+    after the first option; the first letter key ("Ans: C") wins, otherwise the first
+    free-text answer is matched against the options. A label that is out of sequence
+    ("Vitamin D." inside option A), or whose punctuation the grammar does not accept,
+    is plain text. The scan is a single left-to-right pass with no backtracking.
+    Returns None when fewer than min_options options come out, so the caller can
+    fall back.
+    """
+    labels, answers = grammar
+    q_start = block_start
+    q_end = -1
+    opt_start = -1  # end of the label whose option text is still open
+    ans_start = -1  # end of the "Answer:" marker whose free text is still open
+    next_label = "A"
+    opts: list[str] = []
+    correct: Optional[str] = None
+    answer_text: Optional[str] = None
+    for start, end, kind in tokens:
+        if (kind == TOKEN_ANSWER and not answers and end < block_end
+                and text[end] in labels and not text[end - 2].isalnum()):
+            # Without answer markers "Ans: B)" is question text followed by option B
+            start, end, kind = end - 1, end + 1, TOKEN_OPTION
+        if kind == TOKEN_OPTION:
+            if text[start] != next_label or text[end - 1] not in labels:
+                continue
+        elif kind != TOKEN_HEADER and (not answers or next_label == "A"):
+            # Answer markers only count once an option has started ("Fill in: the ans: ____")
+            continue
+        if opt_start >= 0:
+            opt = _ws(text[opt_start:start])
+            if opt:
+                opts.append(opt)
+            opt_start = -1
+        if ans_start >= 0:
+            # An empty "Answer:" leaves the key open for a later marker
+            answer_text = text[ans_start:start] if text[ans_start:start].strip() else None
+            ans_start = -1
+        if kind == TOKEN_HEADER:
+            q_start = end
+            continue
+        if q_end < 0:
+            q_end = start
+        if kind == TOKEN_OPTION:
+            opt_start = end
+            next_label = chr(ord(next_label) + 1)
+        elif kind == TOKEN_ANSWER:
+            # A letter key beats a free-text answer wherever it appears
+            if correct is None:
+                correct = text[end - 1].upper()
+        elif correct is None and answer_text is None:
+            ans_start = end
+            answer_text = ""
+    if opt_start >= 0:
+        opt = _ws(text[opt_start:block_end])
+        if opt:
+            opts.append(opt)
+    if ans_start >= 0:
+        answer_text = text[ans_start:block_end]
+    if len(opts) < min_options:
+        return None
+    if correct is None and answer_text:
+        correct = _match_answer_text(_join_lines(answer_text), opts)
+    question = _join_lines(text[q_start:q_end if q_end >= 0 else block_end])
+    return _make_mcq(question, opts, correct)
+
+
+# ==========================
+# PARSE EXISTING MCQs (Final)
+# ==========================
+# "\r" -> "\n" and drop markdown bold "*" in one pass ("_" is kept for fill-in blanks)
+_CLEAN_TABLE = str.maketrans({"\r": "\n", "*": None})
+_LINE_BREAK_RE = re.compile(r"\s*\n\s*")
+# Every question block needs an "A)" / "B." / "C:" style label somewhere (possibly
+# with markdown "*" before the punctuation, which cleaning strips); prose has none
+_LABEL_SNIFF_RE = re.compile(r"[A-D]\**[).:]")
+
+
+def _parse_mcqs(text: str) -> list[dict]:
+    # Clean text in one pass
+    text = text.translate(_CLEAN_TABLE)
+
+    # Tokenize once; quiz titles and non-question text never become blocks
+    blocks = _tokenize(text)
+
+    # Pick one layout grammar for the whole document from its first questions
+    grammar = _TEMPLATE_GRAMMAR[_classify_template(text, blocks[:2])]
+
+    mcqs: list[dict] = []
+    for start, end, tokens in blocks:
+        mcq = _parse_block(text, start, end, tokens, grammar, 2)
+        if mcq is None:
+            mcq = _parse_block(text, start, end, tokens, _GENERIC_GRAMMAR, 1)
+        # Filter out unwanted intro blocks
+        if mcq is None or sum(len(o) > 2 for o in mcq["options"]) < 2:
+            continue
+
+        # Default missing answers to A
+        if mcq["correct"] is None:
+            mcq["correct"] = "A"
+        mcqs.append(mcq)
+
+    return mcqs
+
+
+# ==========================
+# PARSE CACHE
+# ==========================
+# The same document is parsed again on every Streamlit rerun and re-upload, so
+# results are kept per SHA-1 of the text (not the text itself) in a small LRU.
+_PARSE_CACHE_SIZE = 64
+_parse_cache: "OrderedDict[bytes, tuple[tuple[str, tuple[str, ...], str], ...]]" = OrderedDict()
+_parse_cache_lock = threading.Lock()
+
+
+def parse_mcqs(text: str) -> list[dict]:
+    """
+    Final version of parse_mcqs() – handles multi-line options, multiple numbering formats,
+    and extracts correct answers accurately from text-based quiz documents.
+    """
+    # Uploaded notes that aren't MCQs are rejected in one cheap scan, before hashing
+    if not _LABEL_SNIFF_RE.search(text):
+        return []
+    key = hashlib.sha1(text.encode("utf-8", "surrogatepass")).digest()
+    with _parse_cache_lock:
+        cached = _parse_cache.get(key)
+        if cached is not None:
+            _parse_cache.move_to_end(key)
+    if cached is None:
+        cached = tuple((m["question"], tuple(m["options"]), m["correct"]) for m in _parse_mcqs(text))
+        with _parse_cache_lock:
+            _parse_cache[key] = cached
+            if len(_parse_cache) > _PARSE_CACHE_SIZE:
+                _parse_cache.popitem(last=False)
+    # Hand out fresh dicts so callers can mutate them without touching the cache
+    return [{"question": q, "options": list(opts), "correct": c} for q, opts, c in cached]
@@ -1,14 +1,29 @@
 import os
 import io
+import asyncio
+import atexit
+import csv
+import hashlib
+import multiprocessing
 import re
-import json
-import pdfplumber
-import docx
-import openai
-import pandas as pd
+import orjson
+import queue
+import random
+import shutil
 import smtplib
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from email.mime.text import MIMEText
+from importlib.util import find_spec
+from mcq_parser import parse_mcqs
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 # ==========================
 # CONFIG / SECRETS
@@ -18,22 +33,222 @@ EMAIL_USER = os.getenv("EMAIL_USER")
 EMAIL_PASS = os.getenv("EMAIL_PASS")
 MONGODB_URI = os.getenv("MONGODB_URI", "")
 
-if OPENAI_API_KEY:
-    openai.api_key = OPENAI_API_KEY
-
 # ==========================
 # TEXT EXTRACTION
 # ==========================
+PDF_PARALLEL_MIN_PAGES = 8  # below this, worker start-up costs more than it saves
+OCR_MIN_PAGE_CHARS = 20  # pages with less extracted text than this are treated as scans
+OCR_DPI = 200  # rasterization resolution for Tesseract (pdf2image's default)
+# Scans are OCR'd one page per core. Tesseract also threads each page with OpenMP, so
+# deployments that OCR many-page scans should set OMP_THREAD_LIMIT=1 in the server
+# environment (read when tesseract / tesserocr loads, so it can't be set per request).
+_mupdf_lock = threading.Lock()  # MuPDF is not thread-safe; every pymupdf call holds this
+_tesseract = threading.local()
+
+
+def _iter_page_texts(pages):
+    """Yields each pdfplumber page's text, releasing the page's parsed layout objects as it goes."""
+    for p in pages:
+        yield p.extract_text() or ""
+        # The cached chars/objects dwarf the text; without this every page stays parsed until close
+        p.close()
+
+
+def _extract_pdf_pages(file_bytes, start, stop):
+    """Returns the text of pages [start, stop); runs in a worker process for large PDFs."""
+    import pdfplumber
+    # pages= limits Page construction to this worker's slice instead of the whole document
+    with pdfplumber.open(io.BytesIO(file_bytes), pages=range(start + 1, stop + 1)) as pdf:
+        return list(_iter_page_texts(pdf.pages))
+
+
+def _pdfplumber_page_texts(file_bytes):
+    """Returns per-page text via pdfplumber, spreading large documents over all CPU cores."""
+    import pdfplumber
+    with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
+        n_pages = len(pdf.pages)
+        workers = min(os.cpu_count() or 1, n_pages)
+        if n_pages < PDF_PARALLEL_MIN_PAGES or workers < 2:
+            return list(_iter_page_texts(pdf.pages))
+
+    # pdfminer is pure Python and holds the GIL, so pages go to processes, not threads
+    step = -(-n_pages // workers)
+    starts = range(0, n_pages, step)
+    pages = []
+    # Forking Streamlit's multi-threaded server is unsafe; forkserver/spawn start clean workers
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=len(starts), mp_context=multiprocessing.get_context(method)) as ex:
+        for chunk in ex.map(_extract_pdf_pages, [file_bytes] * len(starts), starts,
+                            [min(s + step, n_pages) for s in starts]):
+            pages.extend(chunk)
+    return pages
+
+
+def _pymupdf_page_texts(file_bytes):
+    """Returns per-page text via PyMuPDF's C extractor."""
+    import pymupdf
+    # Streamlit sessions extract on their own threads, so they take turns with each other and OCR renders
+    with _mupdf_lock:
+        with pymupdf.open(stream=file_bytes, filetype="pdf") as doc:
+            # MuPDF ends every page with a newline; drop it to match pdfplumber
+            return [page.get_text("text").rstrip("\n") for page in doc]
+
+
+def _render_pdf_page(file_bytes, page_no):
+    """Rasterizes a single (1-based) PDF page, in-process with MuPDF or via poppler's pdftoppm."""
+    try:
+        import pymupdf
+    except ImportError:
+        from pdf2image import convert_from_bytes
+        images = convert_from_bytes(file_bytes, dpi=OCR_DPI, first_page=page_no, last_page=page_no)
+        return images[0] if images else None
+    from PIL import Image
+    # OCR workers take turns rendering and overlap only in Tesseract
+    with _mupdf_lock:
+        with pymupdf.open(stream=file_bytes, filetype="pdf") as doc:
+            pix = doc[page_no - 1].get_pixmap(dpi=OCR_DPI)
+            return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+
+def _ocr_image(image):
+    """OCRs one image in-process with tesserocr, or by running the tesseract binary via pytesseract."""
+    try:
+        import tesserocr
+    except ImportError:
+        import pytesseract
+        return pytesseract.image_to_string(image)
+    # Loading the trained model is most of a page's OCR time, so each thread keeps its engine
+    api = getattr(_tesseract, "api", None)
+    if api is None:
+        api = _tesseract.api = tesserocr.PyTessBaseAPI()
+    api.SetImage(image)
+    return api.GetUTF8Text()
+
+
+def _ocr_pdf_page(file_bytes, page_no):
+    """Rasterizes a single (1-based) PDF page and returns its Tesseract text."""
+    image = _render_pdf_page(file_bytes, page_no)
+    return _ocr_image(image) if image is not None else ""
+
+
+def _ocr_available():
+    """True when both a page renderer and a Tesseract engine are installed."""
+    if find_spec("pymupdf") is None and shutil.which("pdftoppm") is None:
+        return False
+    if find_spec("tesserocr") is not None:
+        return True
+    try:
+        import pytesseract
+    except ImportError:
+        return False
+    return shutil.which(pytesseract.pytesseract.tesseract_cmd) is not None
+
+
+def _extract_pdf_text(file_bytes, ocr=True):
+    """
+    Extracts PDF text with PyMuPDF, falling back to pdfplumber if it is missing or fails.
+    Scanned pages are OCR'd when ocr is True. Returns (text, complete); complete is
+    False when the OCR of scanned pages failed.
+    """
+    try:
+        pages = _pymupdf_page_texts(file_bytes)
+    except ImportError:
+        pages = _pdfplumber_page_texts(file_bytes)
+    except Exception as e:
+        print(f"[WARN] _extract_pdf_text: PyMuPDF failed ({e}), retrying with pdfplumber")
+        pages = _pdfplumber_page_texts(file_bytes)
+
+    # OCR only the pages with no text layer (scans), not the whole document
+    scan_pages = [i for i, t in enumerate(pages) if len(t.strip()) < OCR_MIN_PAGE_CHARS]
+    if scan_pages and not ocr:
+        print(f"[WARN] _extract_pdf_text: OCR tools not installed, skipping {len(scan_pages)} scanned pages")
+    elif scan_pages:
+        workers = min(os.cpu_count() or 1, len(scan_pages))
+        try:
+            if workers < 2:
+                texts = [_ocr_pdf_page(file_bytes, i + 1) for i in scan_pages]
+            else:
+                # tesserocr releases the GIL and pytesseract runs a subprocess, so threads overlap OCR
+                with ThreadPoolExecutor(max_workers=workers) as ex:
+                    texts = list(ex.map(_ocr_pdf_page, [file_bytes] * len(scan_pages), [i + 1 for i in scan_pages]))
+            for i, page_text in zip(scan_pages, texts):
+                pages[i] = page_text or pages[i]
+        except Exception as e:
+            print(f"[WARN] _extract_pdf_text: OCR failed, skipping {len(scan_pages)} scanned pages: {e}")
+            return "\n".join(pages), False
+    return "\n".join(pages), True
+
+
+# ==========================
+# EXTRACTED TEXT CACHE
+# ==========================
+# OCR can take minutes and authors re-upload the same PDF often, so extracted text
+# is kept on disk per SHA-256 of the file (and OCR_DPI), evicting least recently used.
+# Text extracted without OCR tools is final for that setup and cached under its own
+# key, so installing them later re-extracts instead of serving the text-only result.
+TEXT_CACHE_DIR = ".ocr_cache"
+TEXT_CACHE_MAX_FILES = 200
+
+
+def _text_cache_path(file_bytes, ocr):
+    key = hashlib.sha256(file_bytes).hexdigest()
+    return os.path.join(TEXT_CACHE_DIR, f"{key}-{OCR_DPI if ocr else 'noocr'}.txt")
+
+
+def _read_text_cache(path):
+    """Returns the cached text, or None on a miss; a hit refreshes the entry's mtime for LRU."""
+    try:
+        with open(path, "r", encoding="utf-8", errors="surrogatepass") as f:
+            text = f.read()
+        os.utime(path)
+        return text
+    except OSError:
+        return None
+
+
+def _write_text_cache(path, text, max_files=TEXT_CACHE_MAX_FILES):
+    """Stores text atomically (temp file + os.replace) and trims the path's cache directory to max_files."""
+    try:
+        cache_dir, ext = os.path.dirname(path), os.path.splitext(path)[1]
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8", errors="surrogatepass") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+        entries = [e for e in os.scandir(cache_dir) if e.name.endswith(ext)]
+        if len(entries) > max_files:
+            entries.sort(key=lambda e: e.stat().st_mtime)
+            for e in entries[:len(entries) - max_files]:
+                try:
+                    os.remove(e.path)
+                except OSError:
+                    pass
+    except OSError as e:
+        print(f"[WARN] _write_text_cache: {e}")
+
+
+def _extract_pdf_text_cached(file_bytes):
+    ocr = _ocr_available()
+    path = _text_cache_path(file_bytes, ocr)
+    text = _read_text_cache(path)
+    if text is None:
+        text, complete = _extract_pdf_text(file_bytes, ocr)
+        # Don't pin a result whose OCR failed part-way; the next upload retries it
+        if complete:
+            _write_text_cache(path, text)
+    return text
+
+
 def extract_text_from_file(file_bytes, filename):
     """Extracts text from PDF, DOCX, or TXT files."""
     name = filename.lower()
     text = ""
     try:
         if name.endswith(".pdf"):
-            with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-                pages = [p.extract_text() or "" for p in pdf.pages]
-                text = "\n".join(pages)
+            text = _extract_pdf_text_cached(file_bytes)
         elif name.endswith(".docx"):
+            import docx
             document = docx.Document(io.BytesIO(file_bytes))
             text = "\n".join([p.text for p in document.paragraphs])
         else:
@@ -46,167 +261,464 @@ def extract_text_from_file(file_bytes, filename):
 # ==========================
 # DETECT MCQ FORMAT
 # ==========================
+# "Q 1" and "Question 1" share one branch so a "q" is only tested once per position
+_MCQ_DETECT = re.compile(r"Q(?:uestion)?\s*\d+|[A-D][).]|Answer\s*[:\-]", re.IGNORECASE)
+
+
 def detect_mcq(text):
     """Detect if document text is already in MCQ format."""
     if not text or len(text.strip()) < 50:
         return False
-    mcq_patterns = [r"Q\s*\d+", r"Question\s*\d+", r"[A-D][).]", r"Answer\s*[:\-]"]
-    return any(re.search(p, text, re.IGNORECASE) for p in mcq_patterns)
+    return bool(_MCQ_DETECT.search(text))
 
 
 # ==========================
-# PARSE EXISTING MCQs (Final)
+# GENERATE MCQs USING OPENAI
 # ==========================
-def parse_mcqs(text):
+OPENAI_MODEL = "gpt-4o-mini"  # structured outputs (json_schema) need gpt-4o-mini or newer
+MCQ_CHUNK_CHARS = 12000  # source text sent per request
+MCQ_CHUNK_OVERLAP_CHARS = 400  # text repeated from the previous chunk so no passage is cut in half
+MCQ_MAX_OUTPUT_TOKENS = 16384  # completion budget of OPENAI_MODEL
+OPENAI_TEMPERATURE = 0.2  # low enough that a re-run of the same text gives near-identical questions
+OPENAI_MAX_CONCURRENCY = 8  # requests in flight at once
+OPENAI_MAX_RETRIES = 5  # retries per request on 429 / 5xx
+OPENAI_BACKOFF_SECONDS = 1.0  # first retry delay, doubled on each attempt
+MCQ_CACHE_DIR = ".mcq_cache"
+MCQ_CACHE_MAX_FILES = 500
+MCQ_PROMPT_VERSION = 1  # bump whenever the prompts or schemas change to retire cached results
+_WHITESPACE_RE = re.compile(r"\s")
+
+
+def _mcq_prompt(text, n_questions):
+    return f"""
+    You are an AI quiz generator.
+    Create {n_questions} multiple-choice questions based on the following content.
+    Each question should have 4 options (A, B, C, D) and the letter of the correct answer.
+    Text:
+    {text}
+    """
+
+
+def _split_text(text, n_chunks, overlap=0):
     """
-    Final version of parse_mcqs() – handles multi-line options, multiple numbering formats,
-    and extracts correct answers accurately from text-based quiz documents.
+    Splits text into at most n_chunks pieces of similar size, cutting at whitespace.
+    Each piece after the first also repeats up to `overlap` characters of the previous one.
+    """
+    size = -(-len(text) // n_chunks)
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + size
+        if end < len(text):
+            m = _WHITESPACE_RE.search(text, end)
+            end = m.end() if m else len(text)
+        lead = start
+        if overlap and start:
+            m = _WHITESPACE_RE.search(text, start - overlap, start)
+            lead = m.end() if m else start
+        chunks.append(text[lead:end])
+        start = end
+    return chunks
+
+
+def _batch_prompt(texts, n_questions):
+    passages = "\n\n".join(f"Passage {i}:\n{t}" for i, t in enumerate(texts, 1))
+    return f"""
+    You are an AI quiz generator.
+    For each of the following {len(texts)} passages (numbered 1..{len(texts)}), create {n_questions}
+    multiple-choice questions based on that passage only.
+    Each question should have 4 options (A, B, C, D) and the letter of the correct answer.
+    Return each passage's questions under its passage number.
+    {passages}
     """
 
-    import re
 
-    # Clean text
-    text = text.replace("\r", "\n")
-    text = re.sub(r"\*+", "", text)
-    text = re.sub(r"\n{2,}", "\n", text).strip()
+# Structured outputs: the server constrains decoding to these schemas, so replies
+# always parse and every question has exactly 4 options and a valid letter
+_MCQ_LIST_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "question": {"type": "string"},
+            "options": {"type": "array", "items": {"type": "string"}, "minItems": 4, "maxItems": 4},
+            "correct": {"type": "string", "enum": ["A", "B", "C", "D"]},
+        },
+        "required": ["question", "options", "correct"],
+        "additionalProperties": False,
+    },
+}
+# Strict mode needs an object at the root
+_MCQ_SCHEMA = {
+    "type": "object",
+    "properties": {"questions": _MCQ_LIST_SCHEMA},
+    "required": ["questions"],
+    "additionalProperties": False,
+}
+
+
+def _batch_schema(n_texts):
+    """One MCQ list per passage number ("1".."n")."""
+    keys = [str(i) for i in range(1, n_texts + 1)]
+    return {
+        "type": "object",
+        "properties": {k: _MCQ_LIST_SCHEMA for k in keys},
+        "required": keys,
+        "additionalProperties": False,
+    }
 
-    lines = [l.strip() for l in text.split("\n") if l.strip()]
 
-    # --- Smartly merge broken lines (continuations)
-    merged = []
-    for i, line in enumerate(lines):
-        # If line starts like A) or 1. etc., keep as new entry
-        if re.match(r"^(Q?\s*\d+[\).:]|[A-D][).:])\s*", line, re.IGNORECASE):
-            merged.append(line)
-        else:
-            # Otherwise, append to previous line (continuation)
-            if merged:
-                merged[-1] += " " + line
-            else:
-                merged.append(line)
-    lines = merged
+def _parse_mcq_json(content):
+    """Parses the model's JSON reply into a list of MCQ dicts."""
+    return orjson.loads(content)["questions"]
+
+
+def _parse_mcq_batch_json(content, n_texts):
+    """Parses a keyed batch reply into one MCQ list per passage, in passage order."""
+    data = orjson.loads(content)
+    return [data[str(i)] for i in range(1, n_texts + 1)]
 
-    # --- Group into question blocks
-    blocks = []
-    current = []
-    for line in lines:
-        if re.match(r"^(Q?\s*\d+[\).:]|Question\s*\d+)", line, re.IGNORECASE):
-            if current:
-                blocks.append(" ".join(current))
-            current = [line]
-        else:
-            current.append(line)
-    if current:
-        blocks.append(" ".join(current))
 
-    mcqs = []
-    for block in blocks:
-        # Skip quiz titles or non-question text
-        if not re.search(r"\b[A-D][).:]\s*", block):
+def _completion_args(prompt, max_tokens, schema):
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": max_tokens,
+        "temperature": OPENAI_TEMPERATURE,
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "mcqs", "strict": True, "schema": schema},
+        },
+        "stream": True,
+    }
+
+
+async def _stream_completion(client, limit, prompt, max_tokens, schema):
+    """
+    Streams one completion and returns its full text. At most OPENAI_MAX_CONCURRENCY
+    requests run at once (via limit), and the failures the SDK itself would retry
+    (connection errors and timeouts, 408/409/429/5xx) are retried with exponential backoff.
+    """
+    import openai
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        try:
+            async with limit:
+                stream = await client.chat.completions.create(**_completion_args(prompt, max_tokens, schema))
+                parts = []
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+                return "".join(parts)
+        except (openai.APIConnectionError, openai.APIStatusError) as e:
+            status = getattr(e, "status_code", None)
+            retryable = status is None or status in (408, 409, 429) or status >= 500
+            if not retryable or attempt == OPENAI_MAX_RETRIES:
+                raise
+            delay = OPENAI_BACKOFF_SECONDS * 2 ** attempt * (1 + random.random())
+            print(f"[WARN] OpenAI request failed ({status or type(e).__name__}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def _request_mcqs(client, limit, text, n_questions):
+    """Requests MCQs for one piece of text."""
+    content = await _stream_completion(
+        client, limit, _mcq_prompt(text, n_questions), 150 * n_questions, _MCQ_SCHEMA
+    )
+    return _parse_mcq_json(content)
+
+
+async def _request_mcq_batch(client, limit, texts, n_questions):
+    """Requests MCQs for several short texts in a single prompt; returns one list per text."""
+    content = await _stream_completion(
+        client, limit, _batch_prompt(texts, n_questions), 150 * n_questions * len(texts),
+        _batch_schema(len(texts)),
+    )
+    return _parse_mcq_batch_json(content, len(texts))
+
+
+def _chunk_jobs(text, n_questions):
+    """Splits a long text into (chunk, n_questions) jobs that are generated concurrently."""
+    n_chunks = min(n_questions, max(1, -(-len(text) // MCQ_CHUNK_CHARS)))
+    chunks = _split_text(text, n_chunks, MCQ_CHUNK_OVERLAP_CHARS) or [text]
+    base, extra = divmod(n_questions, len(chunks))
+    return [(c, base + (1 if i < extra else 0)) for i, c in enumerate(chunks)]
+
+
+async def _gather_mcqs(client, limit, jobs):
+    """
+    Runs one request per (text, n_questions) job at the same time and merges the results.
+    Returns (questions, complete), where complete is False if any request failed.
+    """
+    results = await asyncio.gather(
+        *(_request_mcqs(client, limit, chunk, n) for chunk, n in jobs), return_exceptions=True
+    )
+    questions = []
+    seen = set()
+    complete = True
+    for r in results:
+        if isinstance(r, Exception):
+            print(f"[ERROR] generate_mcqs_via_openai: {r}")
+            complete = False
             continue
+        # Overlapping chunks can yield the same question twice
+        for q in r:
+            key = " ".join(str(q.get("question", "")).lower().split())
+            if key not in seen:
+                seen.add(key)
+                questions.append(q)
+    return questions, complete
 
-        # Extract answer (e.g., Ans: C)
-        ans_match = re.search(r"(?i)\bAns(?:wer)?\s*[:\-]?\s*([A-D])\b", block)
-        correct = ans_match.group(1).upper() if ans_match else "A"
 
-        # Extract question text (up to first option)
-        q_match = re.match(r"^(?:Q?\s*\d+[\).:]\s*)(.*?)(?=\s+[A-D][).:])", block)
-        question = q_match.group(1).strip() if q_match else block.strip()
+def _async_client():
+    import openai
+    # Retries are handled in _stream_completion so they respect the concurrency limit
+    return openai.AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
-        # Extract options (A–D)
-        opts = re.findall(r"[A-D][).:]\s*([^A-D]+)", block)
-        opts = [re.sub(r"\s+", " ", o).strip() for o in opts if o.strip()]
 
-        # Remove "Ans: X" from options
-        opts = [re.sub(r"(?i)\bAns(?:wer)?\s*[:\-]?\s*[A-D]\b", "", o).strip() for o in opts]
+def _mcq_cache_path(text, n_questions):
+    key = f"{MCQ_PROMPT_VERSION}|{OPENAI_MODEL}|{n_questions}|{text}"
+    digest = hashlib.sha256(key.encode("utf-8", "surrogatepass")).hexdigest()
+    return os.path.join(MCQ_CACHE_DIR, f"{digest}.json")
 
-        # Pad/truncate to 4
-        while len(opts) < 4:
-            opts.append("N/A")
-        opts = opts[:4]
 
-        # Final append
-        mcqs.append({
-            "question": question,
-            "options": opts,
-            "correct": correct
-        })
+def _read_mcq_cache(path):
+    """Returns the cached MCQ list, or None on a miss."""
+    cached = _read_text_cache(path)
+    if cached is not None:
+        try:
+            return orjson.loads(cached)
+        except orjson.JSONDecodeError:
+            pass
+    return None
 
-    # Filter out unwanted intro blocks
-    mcqs = [m for m in mcqs if len([o for o in m["options"] if len(o) > 2]) >= 2]
 
-    return mcqs
+async def generate_mcqs_via_openai_async(text, n_questions=8, client=None, limit=None):
+    """
+    Async version of generate_mcqs_via_openai(). When fanning out over many documents,
+    pass one shared client and asyncio.Semaphore so they share the concurrency limit.
+    """
+    # Regenerating a quiz from the same document is common and costs full latency
+    # and tokens, so results are kept on disk per (prompt version, model, n, text)
+    path = _mcq_cache_path(text, n_questions)
+    cached = _read_mcq_cache(path)
+    if cached is not None:
+        return cached
+
+    limit = limit or asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+    if client is None:
+        async with _async_client() as client:
+            questions, complete = await _gather_mcqs(client, limit, _chunk_jobs(text, n_questions))
+    else:
+        questions, complete = await _gather_mcqs(client, limit, _chunk_jobs(text, n_questions))
+    # Don't pin a result that is missing a failed chunk's questions
+    if complete and questions:
+        _write_text_cache(path, orjson.dumps(questions).decode(), MCQ_CACHE_MAX_FILES)
+    return questions
+
 
-# ==========================
-# GENERATE MCQs USING OPENAI
-# ==========================
 def generate_mcqs_via_openai(text, n_questions=8):
     """Uses OpenAI API to generate MCQs from text."""
     if not OPENAI_API_KEY:
         print("⚠️ No OpenAI API key found.")
         return []
 
-    prompt = f"""
-    You are an AI quiz generator.
-    Create {n_questions} multiple-choice questions based on the following content.
-    Each question should have 4 options (A, B, C, D) and the correct answer.
-    Return JSON in this exact format:
-    [
-      {{
-        "question": "...",
-        "options": ["...", "...", "...", "..."],
-        "correct": "A"
-      }}
-    ]
-    Text:
-    {text}
-    """
-
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1200,
-            temperature=0.5,
-        )
-        content = response.choices[0].message.content
-        start = content.find("[")
-        if start != -1:
-            content = content[start:]
-        questions = json.loads(content)
-        for q in questions:
-            if "options" not in q or len(q["options"]) < 4:
-                q["options"] = q.get("options", ["A", "B", "C", "D"])[:4]
-        return questions
+        return asyncio.run(generate_mcqs_via_openai_async(text, n_questions))
     except Exception as e:
         print(f"[ERROR] generate_mcqs_via_openai: {e}")
         return []
 
 
+def _pack_texts(texts, n_questions):
+    """Groups indices of short texts so each group fits one request; long texts stay alone."""
+    max_per_group = max(1, MCQ_MAX_OUTPUT_TOKENS // (150 * n_questions))
+    groups = []
+    current = []
+    size = 0
+    for i, t in enumerate(texts):
+        if len(t) > MCQ_CHUNK_CHARS:
+            groups.append([i])
+            continue
+        if current and (size + len(t) > MCQ_CHUNK_CHARS or len(current) >= max_per_group):
+            groups.append(current)
+            current = []
+            size = 0
+        current.append(i)
+        size += len(t)
+    if current:
+        groups.append(current)
+    return groups
+
+
+async def _generate_mcqs_for_texts(texts, n_questions):
+    out = [[] for _ in texts]
+    # Texts already in the MCQ cache are answered from disk; only the rest are packed
+    paths = [_mcq_cache_path(t, n_questions) for t in texts]
+    missing = []
+    for i, path in enumerate(paths):
+        cached = _read_mcq_cache(path)
+        if cached is None:
+            missing.append(i)
+        else:
+            out[i] = cached
+    if not missing:
+        return out
+
+    groups = [[missing[j] for j in g] for g in _pack_texts([texts[i] for i in missing], n_questions)]
+    limit = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+    async with _async_client() as client:
+        results = await asyncio.gather(
+            *(
+                _request_mcq_batch(client, limit, [texts[i] for i in g], n_questions)
+                if len(g) > 1
+                else generate_mcqs_via_openai_async(texts[g[0]], n_questions, client, limit)
+                for g in groups
+            ),
+            return_exceptions=True,
+        )
+    for g, r in zip(groups, results):
+        if isinstance(r, Exception):
+            print(f"[ERROR] generate_mcqs_for_texts: {r}")
+        elif len(g) > 1:
+            for i, questions in zip(g, r):
+                out[i] = questions
+                # Single-text groups cache themselves in generate_mcqs_via_openai_async
+                if questions:
+                    _write_text_cache(paths[i], orjson.dumps(questions).decode(), MCQ_CACHE_MAX_FILES)
+        else:
+            out[g[0]] = r
+    return out
+
+
+def generate_mcqs_for_texts(texts, n_questions=8):
+    """Generates n_questions MCQs for each text, packing short texts into shared prompts."""
+    if not OPENAI_API_KEY:
+        print("⚠️ No OpenAI API key found.")
+        return [[] for _ in texts]
+
+    try:
+        return asyncio.run(_generate_mcqs_for_texts(texts, n_questions))
+    except Exception as e:
+        print(f"[ERROR] generate_mcqs_for_texts: {e}")
+        return [[] for _ in texts]
+
+
 # ==========================
 # SEND EMAIL RESULTS
 # ==========================
+# Streamlit runs every rerun on a new thread, so the session is shared module-wide
+# (one per server process) and _smtp_lock serializes its use.
+SMTP_MAX_AGE_SECONDS = 300  # renew before Gmail drops the session as idle
+SMTP_TIMEOUT_SECONDS = 30  # socket timeout, so a half-open session can't hold _smtp_lock forever
+SMTP_POOL_SIZE = 5  # connections for bulk sends (Gmail allows 15 per account)
+SMTP_MESSAGES_PER_CONNECTION = 100  # recycle bulk connections to stay under per-session limits
+SMTP_MAX_RETRIES = 3  # retries per message on transient failures
+SMTP_BACKOFF_SECONDS = 1.0  # first retry delay, doubled on each attempt
+SMTP_TRANSIENT_CODES = {421, 450, 454}
+_smtp_server = None
+_smtp_deadline = 0.0
+_smtp_lock = threading.Lock()
+
+
+def _get_smtp():
+    """Returns the shared logged-in Gmail SMTP connection, renewing it once it is too old. Hold _smtp_lock."""
+    global _smtp_server, _smtp_deadline
+    if _smtp_server is not None and time.monotonic() >= _smtp_deadline:
+        _drop_smtp()
+    if _smtp_server is None:
+        _smtp_server = _connect_smtp()
+        _smtp_deadline = time.monotonic() + SMTP_MAX_AGE_SECONDS
+    return _smtp_server
+
+
+def _connect_smtp():
+    server = smtplib.SMTP_SSL("smtp.gmail.com", 465, timeout=SMTP_TIMEOUT_SECONDS)
+    server.login(EMAIL_USER, EMAIL_PASS)
+    return server
+
+
+def _close_smtp(server):
+    if server is not None:
+        try:
+            server.close()
+        except OSError:
+            pass
+
+
+def _drop_smtp():
+    """Closes and forgets the shared SMTP connection after a failure. Hold _smtp_lock."""
+    global _smtp_server
+    server = _smtp_server
+    _smtp_server = None
+    _close_smtp(server)
+
+
+def _quit_smtp():
+    """Logs out of the shared SMTP session at interpreter exit instead of dropping the socket."""
+    global _smtp_server
+    # Don't hang shutdown behind a send stuck on a dead socket
+    if not _smtp_lock.acquire(timeout=5):
+        return
+    try:
+        server = _smtp_server
+        _smtp_server = None
+        if server is not None:
+            server.quit()
+    except Exception:
+        pass
+    finally:
+        _smtp_lock.release()
+
+
+atexit.register(_quit_smtp)
+
+
+def _send_message(msg):
+    """Sends over the shared session, reconnecting and retrying once if it went stale. Hold _smtp_lock."""
+    try:
+        _get_smtp().send_message(msg)
+    except smtplib.SMTPRecipientsRefused:
+        # A bad address leaves the session usable; reconnecting wouldn't change the answer
+        raise
+    except OSError as e:
+        # Same for permanent (5xx) replies such as rejected credentials or senders
+        if getattr(e, "smtp_code", 0) >= 500:
+            raise
+        # Dropped or timed-out sessions only show up on use, so no NOOP probe per send
+        _drop_smtp()
+        try:
+            _get_smtp().send_message(msg)
+        except Exception:
+            _drop_smtp()
+            raise
+
+
+def _build_result_message(to_email, student_name, quiz_title, score, total):
+    """Builds the result email for one student."""
+    subject = f"SmartQuiz AI Results – {quiz_title}"
+    percent = round((score / total) * 100, 2)
+    body = (
+        f"Hello {student_name},\n\n"
+        f"Thank you for completing the quiz: {quiz_title}\n"
+        f"Your Score: {score}/{total} ({percent}%)\n\n"
+        "Keep learning!\nSmartQuiz AI"
+    )
+    msg = MIMEText(body)
+    msg["Subject"] = subject
+    msg["From"] = EMAIL_USER
+    msg["To"] = to_email
+    return msg
+
+
 def send_result_email(to_email, student_name, quiz_title, score, total):
     """Sends quiz results to student via Gmail SMTP."""
     if not EMAIL_USER or not EMAIL_PASS:
         print("⚠️ Email credentials missing.")
         return False
     try:
-        subject = f"SmartQuiz AI Results – {quiz_title}"
-        percent = round((score / total) * 100, 2)
-        body = (
-            f"Hello {student_name},\n\n"
-            f"Thank you for completing the quiz: {quiz_title}\n"
-            f"Your Score: {score}/{total} ({percent}%)\n\n"
-            "Keep learning!\nSmartQuiz AI"
-        )
-        msg = MIMEText(body)
-        msg["Subject"] = subject
-        msg["From"] = EMAIL_USER
-        msg["To"] = to_email
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(EMAIL_USER, EMAIL_PASS)
-            server.send_message(msg)
+        msg = _build_result_message(to_email, student_name, quiz_title, score, total)
+        with _smtp_lock:
+            _send_message(msg)
         print(f"✅ Email sent to {to_email}")
         return True
     except Exception as e:
@@ -214,13 +726,138 @@ def send_result_email(to_email, student_name, quiz_title, score, total):
         return False
 
 
+def _send_worker(jobs, abort):
+    """
+    Drains the message queue over one private SMTP connection; returns the number sent.
+    Sets abort, stopping every worker, when login is refused (5xx) or the server stays
+    unreachable, since each further message would only repeat the failure.
+    """
+    server = None
+    used = 0
+    sent = 0
+    while not abort.is_set():
+        try:
+            msg = jobs.get_nowait()
+        except queue.Empty:
+            break
+        for attempt in range(SMTP_MAX_RETRIES + 1):
+            connecting = False
+            try:
+                if server is None or used >= SMTP_MESSAGES_PER_CONNECTION:
+                    _close_smtp(server)
+                    server = None
+                    connecting = True
+                    server = _connect_smtp()
+                    connecting = False
+                    used = 0
+                server.send_message(msg)
+                used += 1
+                sent += 1
+                break
+            except smtplib.SMTPRecipientsRefused as e:
+                print(f"[ERROR] send_result_emails_batch: {msg['To']} refused: {e}")
+                break
+            except OSError as e:
+                # SMTPException is an OSError; only 421/450/454 and dropped connections are worth retrying
+                code = getattr(e, "smtp_code", None)
+                permanent = code is not None and code not in SMTP_TRANSIENT_CODES
+                if connecting and (permanent or attempt == SMTP_MAX_RETRIES):
+                    # Bad credentials or no route to Gmail: retrying per message risks an account lockout
+                    print(f"[ERROR] send_result_emails_batch: can't connect to SMTP, stopping: {e}")
+                    abort.set()
+                    break
+                if attempt == SMTP_MAX_RETRIES or permanent:
+                    print(f"[ERROR] send_result_emails_batch: {msg['To']}: {e}")
+                    break
+                _close_smtp(server)
+                server = None
+                if abort.is_set():
+                    break
+                time.sleep(SMTP_BACKOFF_SECONDS * 2 ** attempt)
+    if server is not None:
+        try:
+            server.quit()
+        except OSError:
+            pass
+    return sent
+
+
+def send_result_emails_batch(items):
+    """Sends results for many attempts over a small pool of SMTP connections; returns the number sent."""
+    if not EMAIL_USER or not EMAIL_PASS:
+        print("⚠️ Email credentials missing.")
+        return 0
+    jobs = queue.Queue()
+    for r in items:
+        jobs.put(_build_result_message(
+            r["student_email"], r["student_name"], r["quiz_title"], r["score"], r["total"]
+        ))
+    total = jobs.qsize()
+    workers = min(SMTP_POOL_SIZE, total)
+    if not workers:
+        return 0
+    abort = threading.Event()
+    # Each worker owns its connection, so SMTP round trips overlap across workers
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        sent = sum(ex.map(_send_worker, [jobs] * workers, [abort] * workers))
+    if sent:
+        print(f"✅ {sent} of {total} result emails sent")
+    else:
+        print(f"[ERROR] send_result_emails_batch: none of {total} result emails were sent")
+    return sent
+
+
 # ==========================
-# RECORD ATTEMPT (LOCAL JSON)
+# RECORD ATTEMPT (LOCAL JSON LINES)
 # ==========================
-LOCAL_RESULTS_FILE = "results.json"
+LOCAL_RESULTS_FILE = "results.jsonl"
+LEGACY_RESULTS_FILE = "results.json"
+_RESULTS_OPEN_FLAGS = os.O_RDWR | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0)
+
+
+@contextmanager
+def _results_lock(shared=False):
+    """
+    Advisory flock on a sidecar file, so several server processes don't interleave the
+    legacy migration, appends and reads (a no-op where fcntl is unavailable, e.g. Windows).
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(LOCAL_RESULTS_FILE + ".lock", "ab") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _dump_attempt(attempt):
+    """Serializes one attempt as a JSON line (answers may be keyed by question index)."""
+    return orjson.dumps(attempt, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+
+
+def _migrate_legacy_results():
+    """Converts an old results.json array into results.jsonl once."""
+    if os.path.exists(LOCAL_RESULTS_FILE) or not os.path.exists(LEGACY_RESULTS_FILE):
+        return
+    try:
+        with _results_lock():
+            # Another process may have migrated while we waited for the lock
+            if os.path.exists(LOCAL_RESULTS_FILE) or not os.path.exists(LEGACY_RESULTS_FILE):
+                return
+            with open(LEGACY_RESULTS_FILE, "rb") as f:
+                legacy = orjson.loads(f.read())
+            with open(LOCAL_RESULTS_FILE, "wb") as f:
+                for attempt in legacy:
+                    f.write(_dump_attempt(attempt))
+            os.replace(LEGACY_RESULTS_FILE, LEGACY_RESULTS_FILE + ".migrated")
+    except Exception as e:
+        print(f"[ERROR] _migrate_legacy_results: {e}")
+
 
 def record_attempt(quiz_id, quiz_title, student_name, student_email, answers, score, total):
-    """Saves student attempt locally (JSON fallback)."""
+    """Appends student attempt to the local JSON Lines file (one record per line)."""
     attempt = {
         "quiz_id": quiz_id,
         "quiz_title": quiz_title,
@@ -232,42 +869,134 @@ def record_attempt(quiz_id, quiz_title, student_name, student_email, answers, sc
         "timestamp": datetime.utcnow().isoformat(),
     }
     try:
-        existing = []
-        if os.path.exists(LOCAL_RESULTS_FILE):
-            with open(LOCAL_RESULTS_FILE, "r", encoding="utf-8") as f:
-                existing = json.load(f)
-        existing.append(attempt)
-        with open(LOCAL_RESULTS_FILE, "w", encoding="utf-8") as f:
-            json.dump(existing, f, indent=2)
+        _migrate_legacy_results()
+        line = _dump_attempt(attempt)
+        # O_APPEND puts each write at the current end of file and one os.write() per record
+        # keeps it whole; the lock also orders the torn-line check against other writers
+        with _results_lock():
+            fd = os.open(LOCAL_RESULTS_FILE, _RESULTS_OPEN_FLAGS, 0o644)
+            try:
+                # Start on a fresh line if an earlier append was cut off mid-record
+                end = os.lseek(fd, 0, os.SEEK_END)
+                if end:
+                    os.lseek(fd, end - 1, os.SEEK_SET)
+                    if os.read(fd, 1) != b"\n":
+                        line = b"\n" + line
+                os.write(fd, line)
+            finally:
+                os.close(fd)
         return attempt
     except Exception as e:
         print(f"[ERROR] record_attempt: {e}")
         return attempt
 
 
+# The admin dashboard lists attempts on every rerun; since the log is append-only,
+# already-parsed records are kept and only bytes appended since the last call are read.
+_attempts_cache = {"file_id": None, "offset": 0, "attempts": []}
+_attempts_cache_lock = threading.Lock()
+
+
 def list_attempts():
     """Returns list of saved attempts."""
+    _migrate_legacy_results()
     if not os.path.exists(LOCAL_RESULTS_FILE):
         return []
+    attempts = []
+    bad = 0
     try:
-        with open(LOCAL_RESULTS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except:
-        return []
+        # Shared lock: readers never see an append half-written
+        with _attempts_cache_lock, _results_lock(shared=True), open(LOCAL_RESULTS_FILE, "rb") as f:
+            cache = _attempts_cache
+            st = os.fstat(f.fileno())
+            # A replaced or truncated file invalidates everything parsed so far
+            file_id = (st.st_dev, st.st_ino)
+            if cache["file_id"] != file_id or st.st_size < cache["offset"]:
+                cache.update(file_id=file_id, offset=0, attempts=[])
+            f.seek(cache["offset"])
+            tail = b""
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Unterminated last line: report it, but re-read it once it is complete
+                    tail = line
+                    break
+                cache["offset"] += len(line)
+                if not line.strip():
+                    continue
+                try:
+                    cache["attempts"].append(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    bad += 1
+            attempts = list(cache["attempts"])
+            if tail.strip():
+                try:
+                    attempts.append(orjson.loads(tail))
+                except orjson.JSONDecodeError:
+                    bad += 1
+    except Exception as e:
+        print(f"[ERROR] list_attempts: {e}")
+    # A torn append (crash mid-write) only loses its own line, not the whole history
+    if bad:
+        print(f"[WARN] list_attempts: skipped {bad} unreadable lines in {LOCAL_RESULTS_FILE}")
+    return attempts
 
 
 # ==========================
 # EXPORT TO EXCEL
 # ==========================
+def _write_xlsx_xlsxwriter(buf, keys, rows):
+    import xlsxwriter
+    # constant_memory flushes each row to disk as soon as the next one starts
+    wb = xlsxwriter.Workbook(buf, {"constant_memory": True})
+    ws = wb.add_worksheet("Sheet1")
+    ws.write_row(0, 0, keys)
+    for r, row in enumerate(rows, 1):
+        ws.write_row(r, 0, [row.get(k) for k in keys])
+    wb.close()
+
+
+def _write_xlsx_openpyxl(buf, keys, rows):
+    from openpyxl import Workbook
+    # write_only streams rows into the workbook instead of building a cell grid
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    ws.append(keys)
+    for row in rows:
+        ws.append([row.get(k) for k in keys])
+    wb.save(buf)
+
+
 def export_results_to_excel_bytes(data):
     """Exports student results to an Excel file (bytes)."""
     try:
-        df = pd.DataFrame(data)
+        keys = list(data[0].keys()) if data else []
         buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="openpyxl") as writer:
-            df.to_excel(writer, index=False)
+        try:
+            _write_xlsx_xlsxwriter(buf, keys, data)
+        except ImportError:
+            _write_xlsx_openpyxl(buf, keys, data)
         buf.seek(0)
         return buf
     except Exception as e:
         print(f"[ERROR] export_results_to_excel_bytes: {e}")
         return None
+
+
+# ==========================
+# EXPORT TO CSV
+# ==========================
+def export_results_to_csv_bytes(data):
+    """Exports student results to a CSV file (bytes); far cheaper than Excel for large exports."""
+    try:
+        buf = io.BytesIO()
+        # utf-8-sig writes a BOM so Excel opens non-ASCII names correctly
+        text = io.TextIOWrapper(buf, encoding="utf-8-sig", newline="")
+        writer = csv.DictWriter(text, fieldnames=list(data[0].keys()) if data else [])
+        writer.writeheader()
+        writer.writerows(data)
+        text.detach()
+        buf.seek(0)
+        return buf
+    except Exception as e:
+        print(f"[ERROR] export_results_to_csv_bytes: {e}")
+        return None